@@ -1,5 +1,6 @@
 #!/usr/bin/python3
 
+from itertools import count
 from sys import argv
 from timeit import timeit
 
@@ -16,6 +17,19 @@ def make_test(template=None, data=None, expected=None):
     return test
 
 
+def make_one_shot_test(template=None, data=None, expected=None):
+    # A standalone comment makes each template new without changing the output
+    templates = ("{{! %d }}\n%s" % (i, template) for i in count())
+
+    def test():
+        result = chevron_blue.render(next(templates), data)
+        if result != expected:
+            error = "Test failed:\n-- got --\n{}\n-- expected --\n{}"
+            raise Exception(error.format(result, expected))
+
+    return test
+
+
 def main(times):
     args = {
         "template": """\
@@ -72,8 +86,10 @@ def main(times):
     }
 
     test = make_test(**args)
+    one_shot_test = make_one_shot_test(**args)
 
     print(timeit(test, number=times))
+    print(timeit(one_shot_test, number=times))
 
 
 if __name__ == "__main__":
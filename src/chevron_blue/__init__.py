@@ -1,5 +1,12 @@
 from .main import cli_main, main
-from .renderer import render
+from .renderer import compile, render, set_cache_size
 from .tokenizer import ChevronError
 
-__all__ = ["main", "render", "cli_main", "ChevronError"]
+__all__ = [
+    "main",
+    "render",
+    "compile",
+    "set_cache_size",
+    "cli_main",
+    "ChevronError",
+]
@@ -1,9 +1,15 @@
 from __future__ import annotations
 
+import builtins
 import io
+import os
+import re
+import threading
 import typing as t
 import warnings
-from collections.abc import Callable, Iterator, Sequence
+from collections import OrderedDict
+from collections.abc import Iterator, Sequence
+from functools import lru_cache
 from os import path
 
 from .tokenizer import tokenize
@@ -16,111 +22,349 @@ if t.TYPE_CHECKING:
 #
 
 
-def _html_escape(string):
-    """HTML escape all of these " & < >"""
+class _Context(t.NamedTuple):
+    """The options that stay the same for a whole render"""
 
-    html_codes = {
-        '"': "&quot;",
+    on_missing_key: OnMissingKey
+    keep: bool
+    def_ldel: str
+    def_rdel: str
+    no_escape: bool
+    partials_path: str | None
+    partials_ext: str
+    partials_dict: dict
+
+
+_HTML_ESCAPE_RE = re.compile(r'[&<>"]')
+_HTML_ESCAPE_TABLE = str.maketrans(
+    {
+        "&": "&amp;",
         "<": "&lt;",
         ">": "&gt;",
+        '"': "&quot;",
     }
+)
+
+
+def _html_escape(string):
+    """HTML escape all of these " & < >"""
+
+    # Most strings have nothing to escape, so return them untouched
+    if not _HTML_ESCAPE_RE.search(string):
+        return string
 
-    # & must be handled first
-    string = string.replace("&", "&amp;")
-    for char in html_codes:
-        string = string.replace(char, html_codes[char])
-    return string
+    # Otherwise escape every character in a single pass
+    return string.translate(_HTML_ESCAPE_TABLE)
 
 
-def _get_key(key, scopes, on_missing_key: OnMissingKey, keep, def_ldel, def_rdel):
+_MISSING = object()
+
+
+def _maybe_int(child):
+    """Convert a key to an int if it is one, otherwise return None"""
+    try:
+        return int(child)
+    except ValueError:
+        return None
+
+
+@lru_cache(maxsize=1024)
+def _split_key(key):
+    """Split a dotted key into (child, int(child) or None) pairs"""
+    return tuple((child, _maybe_int(child)) for child in key.split("."))
+
+
+def _get_child(scope, child, child_int):
+    """Get a child of a scope that isn't a dict, or _MISSING"""
+    try:
+        # Try subscripting (Dictionary-like types)
+        return scope[child]
+    except (TypeError, AttributeError):
+        pass
+    except (KeyError, IndexError, ValueError):
+        return _MISSING
+
+    try:
+        return getattr(scope, child)
+    except (TypeError, AttributeError):
+        pass
+    except (KeyError, IndexError, ValueError):
+        return _MISSING
+
+    # Try as a list
+    if child_int is None:
+        return _MISSING
+    try:
+        return scope[child_int]
+    except (AttributeError, KeyError, IndexError, ValueError):
+        return _MISSING
+
+
+def _get_key(key, scopes, ctx: _Context):
     """Get a key from the current scope"""
 
     # If the key is a dot
     if key == ".":
         # Then just return the current scope
-        return scopes[0]
-
-    # Loop through the scopes
-    for scope in scopes:
-        key_index = 0
-        try:
-            # For every dot seperated key
-            for key_index, child in enumerate(key.split(".")):
-                # Move into the scope
-                try:
-                    # Try subscripting (Normal dictionaries)
-                    scope = scope[child]
-                except (TypeError, AttributeError):
-                    try:
-                        scope = getattr(scope, child)
-                    except (TypeError, AttributeError):
-                        # Try as a list
-                        scope = scope[int(child)]
-
-            # Return an empty string if falsy, with two exceptions
-            # 0 should return 0, and False should return False
-            if scope in (0, False):
-                return scope
+        return scopes[-1]
+
+    children = _split_key(key)
+
+    # Loop through the scopes, from the most recent
+    for scope in reversed(scopes):
+        # For every dot seperated key
+        for key_index, (child, child_int) in enumerate(children):
+            # Move into the scope
+            scope_type = type(scope)
+            if scope_type is dict:
+                # Normal dictionaries
+                scope = scope.get(child, _MISSING)
+            elif scope_type is list or scope_type is tuple:
+                # Normal lists, which can't be subscripted by a string
+                if child_int is None:
+                    scope = getattr(scope, child, _MISSING)
+                elif -len(scope) <= child_int < len(scope):
+                    scope = scope[child_int]
+                else:
+                    scope = _MISSING
+            else:
+                scope = _get_child(scope, child, child_int)
 
+            if scope is _MISSING:
+                break
+        else:
             try:
-                # This allows for custom falsy data types
-                # https://github.com/noahmorrison/chevron/issues/35
-                if scope._CHEVRON_return_scope_when_falsy:
+                # Return an empty string if falsy, with two exceptions
+                # 0 should return 0, and False should return False
+                if scope in (0, False):
                     return scope
-            except AttributeError:
-                return scope or ""
-        except (AttributeError, KeyError, IndexError, ValueError):
-            # We couldn't find the key in the current scope
-            # We'll try again on the next pass if this is the first key
-            # Otherwise, we should not continue up the stack
-            # ref https://github.com/mustache/spec/pull/48#issuecomment-5919586
-            if key_index > 0:
-                break
+
+                try:
+                    # This allows for custom falsy data types
+                    # https://github.com/noahmorrison/chevron/issues/35
+                    if scope._CHEVRON_return_scope_when_falsy:
+                        return scope
+                except AttributeError:
+                    return scope or ""
+                continue
+            except (AttributeError, KeyError, IndexError, ValueError):
+                pass
+
+        # We couldn't find the key in the current scope
+        # We'll try again on the next pass if this is the first key
+        # Otherwise, we should not continue up the stack
+        # ref https://github.com/mustache/spec/pull/48#issuecomment-5919586
+        if key_index > 0:
+            break
 
     # We couldn't find the key in any of the scopes
 
-    if on_missing_key == "warn":
+    if ctx.on_missing_key == "warn":
         warnings.warn(
             "Could not find key '%s' in data" % key,
             UserWarning,
             stacklevel=2,
         )
-    elif on_missing_key == "error":
+    elif ctx.on_missing_key == "error":
         raise KeyError("Could not find key '%s'" % key)
 
-    if keep:
-        return "%s %s %s" % (def_ldel, key, def_rdel)
+    if ctx.keep:
+        return "%s %s %s" % (ctx.def_ldel, key, ctx.def_rdel)
 
     return ""
 
 
+@lru_cache(maxsize=256)
+def _load_partial(partial_path, mtime_ns):
+    """Read a partial from the file system
+
+    The modification time is part of the cache key so that edited
+    files are read again.
+    """
+    try:
+        with io.open(partial_path, "r", encoding="utf-8") as partial:
+            return partial.read()
+
+    except IOError:
+        return ""
+
+
+@lru_cache(maxsize=256)
+def _partial_path(name, partials_path, partials_ext):
+    """Get the path of a partial in the file system"""
+    path_ext = "." + partials_ext if partials_ext else ""
+    return path.join(partials_path, name + path_ext)
+
+
 def _get_partial(name, partials_dict, partials_path, partials_ext):
     """Load a partial"""
+    # Maybe the partial is in the dictionary. Plain dicts are checked
+    # without raising, anything else is subscripted, to respect
+    # __missing__ and mappings without a get()
+    if type(partials_dict) is dict:
+        partial = partials_dict.get(name, _MISSING)
+        if partial is not _MISSING:
+            return partial
+    else:
+        try:
+            return partials_dict[name]
+        except KeyError:
+            pass
+
+    # Don't try loading from the file system if the partials_path is None or empty
+    if partials_path is None or partials_path == "":
+        return ""
+
+    # Nope...
     try:
-        # Maybe the partial is in the dictionary
-        return partials_dict[name]
-    except KeyError:
-        # Don't try loading from the file system if the partials_path is None or empty
-        if partials_path is None or partials_path == "":
-            return ""
+        # Maybe it's in the file system. The absolute path depends on the
+        # current directory, so only the joined path is cached
+        partial_path = path.abspath(_partial_path(name, partials_path, partials_ext))
+        mtime_ns = os.stat(partial_path).st_mtime_ns
 
-        # Nope...
-        try:
-            # Maybe it's in the file system
-            path_ext = "." + partials_ext if partials_ext else ""
-            partial_path = path.join(partials_path, name + path_ext)
-            with io.open(partial_path, "r", encoding="utf-8") as partial:
-                return partial.read()
-
-        except IOError:
-            # Alright I give up on you
-            return ""
+    except OSError:
+        # Alright I give up on you
+        return ""
+
+    return _load_partial(partial_path, mtime_ns)
+
+
+def _section_ends(tokens):
+    """Find the index of the end tag closing each section
+
+    Returns a tuple the same length as the tokens, holding the index of
+    the matching end tag for every (inverted) section and None otherwise.
+    Sections that are never closed run to the end of the tokens.
+    """
+    ends = [None] * len(tokens)
+    open_sections = []
+    for index, (tag, _) in enumerate(tokens):
+        if tag == "section" or tag == "inverted section":
+            ends[index] = len(tokens)
+            open_sections.append(index)
+        elif tag == "end" and open_sections:
+            ends[open_sections.pop()] = index
+
+    return tuple(ends)
+
+
+@lru_cache(maxsize=512)
+def _tokenize_cached(template, def_ldel, def_rdel):
+    """Tokenize a template string, caching the tokens and section ends"""
+    tokens = tuple(tokenize(template, def_ldel, def_rdel))
+    return tokens, _section_ends(tokens)
 
 
 #
 # The main rendering function
 #
-g_token_cache = {}
+
+# How to write each type of tag back out as template text: what goes
+# before and after its key, inside the delimiters
+_RECONSTRUCT = {
+    "comment": ("! ", ""),
+    "section": ("# ", ""),
+    "inverted section": ("^ ", ""),
+    "end": ("/ ", ""),
+    "partial": ("> ", ""),
+    "set delimiter": ("= ", ""),
+    "no escape": ("& ", " "),
+    "variable": (" ", ""),
+}
+
+
+@lru_cache(maxsize=32)
+def _tag_affixes(def_ldel, def_rdel):
+    """Get what goes before and after the key of each type of tag"""
+    affixes = {
+        tag_type: (def_ldel + before, after + def_rdel)
+        for tag_type, (before, after) in _RECONSTRUCT.items()
+    }
+    # Literals are written out as they are
+    affixes["literal"] = ("", "")
+    return affixes
+
+
+class _LRU(OrderedDict):
+    """An OrderedDict that forgets its least recently used items"""
+
+    def __init__(self, size):
+        super().__init__()
+        self.size = size
+        # Renders in other threads may be setting keys at the same time
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Get a key, marking it as the most recently used"""
+        with self._lock:
+            value = super().get(key, _MISSING)
+            if value is _MISSING:
+                return default
+            self.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """Set a key, forgetting the oldest keys if there are too many"""
+        with self._lock:
+            self[key] = value
+            self.move_to_end(key)
+            self._trim()
+
+    def resize(self, size):
+        """Change how many keys are kept"""
+        with self._lock:
+            self.size = size
+            self._trim()
+
+    def _trim(self):
+        while len(self) > self.size:
+            self.popitem(last=False)
+
+
+# Tokens (and section ends) of the section text handed to lambdas,
+# keyed by that text and the delimiters it was written with
+_TOKEN_CACHE_SIZE = 256
+g_token_cache = _LRU(_TOKEN_CACHE_SIZE)
+
+
+def set_cache_size(size):
+    """Set how many lambda sections to keep the tags of
+
+    Lambdas are given their section as text. A lambda rendering its own
+    text always reuses the section's tags, and the sections kept here
+    also let the same text be rendered elsewhere (by another lambda or
+    call) without tokenizing it again. Lambdas whose text varies from
+    call to call may want fewer kept. The default is 256.
+    """
+    if not isinstance(size, int):
+        raise TypeError("The cache size must be an int.")
+    if size < 0:
+        raise ValueError("The cache size must not be negative.")
+    g_token_cache.resize(size)
+
+
+def _get_tokens(template, def_ldel, def_rdel):
+    """Get the tokens and section ends of a template"""
+
+    # If the template is a seqeuence but not derived from a string
+    if isinstance(template, Sequence) and not isinstance(template, str):
+        # Then we don't need to tokenize it
+        # But it does need to be indexable
+        tokens = template if isinstance(template, tuple) else tuple(template)
+        return tokens, _section_ends(tokens)
+
+    # If the template is a file-like object then read it
+    if not isinstance(template, str):
+        try:
+            template = template.read()
+        except AttributeError:
+            pass
+
+    cached = g_token_cache.get((template, def_ldel, def_rdel))
+    if cached is None:
+        # Otherwise tokenize it (or reuse the cached tokens)
+        cached = _tokenize_cached(template, def_ldel, def_rdel)
+    return cached
 
 
 def render(
@@ -156,6 +400,7 @@ def render(
     Arguments:
 
     template      -- A file-like object or a string containing the template
+                     (or a template made by compile())
 
     data          -- A python dictionary with your data scope
 
@@ -211,234 +456,564 @@ def render(
             )
         on_missing_key = "warn" if warn else "ignore"
 
-    # If the template is a seqeuence but not derived from a string
-    if isinstance(template, Sequence) and not isinstance(template, str):
-        # Then we don't need to tokenize it
-        # But it does need to be a generator
-        tokens = (token for token in template)
+    # The most recent scope is kept at the end of the list
+    if scopes is None:
+        scopes = [data]
     else:
-        if template in g_token_cache:
-            tokens = (token for token in g_token_cache[template])
-        else:
-            # Otherwise make a generator
-            tokens = tokenize(template, def_ldel, def_rdel)
+        scopes = list(reversed(scopes))
 
-    output = ""
+    ctx = _Context(
+        on_missing_key,
+        keep,
+        def_ldel,
+        def_rdel,
+        no_escape,
+        partials_path,
+        partials_ext,
+        partials_dict,
+    )
+    return _render_template(template, scopes, padding, ctx)
 
-    if scopes is None:
-        scopes = [data]
+
+def compile(template, def_ldel="{{", def_rdel="}}"):
+    """Compile a mustache template to render many times.
+
+    compile(open('main.ms', 'r')).render({...}, 'partials', 'ms')
+    is the same as the call in render()'s example, but the template is
+    only read and compiled once however many times it's rendered.
+
+    Arguments:
+
+    template      -- A file-like object or a string containing the template
+
+    def_ldel      -- The default left delimiter
+                     ("{{" by default, as in spec compliant mustache)
+
+    def_rdel      -- The default right delimiter
+                     ("}}" by default, as in spec compliant mustache)
+
+    Returns:
+
+    A Template, with a render() method taking the rest of render()'s
+    arguments.
+    """
+    return Template(template, def_ldel, def_rdel)
+
+
+class Template:
+    """A mustache template, compiled by compile()"""
+
+    def __init__(self, template, def_ldel="{{", def_rdel="}}"):
+        # If the template is a file-like object then read it
+        if not isinstance(template, str):
+            try:
+                template = template.read()
+            except AttributeError:
+                pass
+
+        self.def_ldel = def_ldel
+        self.def_rdel = def_rdel
+
+        tokens, ends = _get_tokens(template, def_ldel, def_rdel)
+        try:
+            compiled = _compile(tokens, ends)
+        except RecursionError:
+            # Compiled too deep in the stack, so interpret it instead
+            compiled = None
+        self._tokens, self._ends, self._compiled = tokens, ends, compiled
+
+    def render(
+        self,
+        data={},
+        partials_path=".",
+        partials_ext="mustache",
+        partials_dict={},
+        padding="",
+        scopes=None,
+        warn=None,
+        keep=False,
+        no_escape=False,
+        on_missing_key: OnMissingKey | None = None,
+    ):
+        """Render the template, with the same arguments as render()"""
+        return render(
+            self,
+            data,
+            partials_path,
+            partials_ext,
+            partials_dict,
+            padding,
+            self.def_ldel,
+            self.def_rdel,
+            scopes,
+            warn,
+            keep,
+            no_escape,
+            on_missing_key,
+        )
+
+    def _render_with(self, scopes, padding, ctx: _Context):
+        # Templates nested too deeply to compile are interpreted instead
+        if self._compiled is None:
+            return _render(self._tokens, self._ends, scopes, padding, ctx)
+        return self._compiled(scopes, padding, ctx)
+
+
+def _render_template(template, scopes, padding, ctx: _Context):
+    """Render a template, compiling it if it's a string seen before"""
+
+    # If the template has already been compiled
+    if isinstance(template, Template):
+        return template._render_with(scopes, padding, ctx)
+
+    # If the template is a file-like object then read it
+    if not isinstance(template, str):
+        try:
+            template = template.read()
+        except AttributeError:
+            pass
+
+    # A string without any tags is just a literal
+    if isinstance(template, str) and ctx.def_ldel not in template:
+        # which renders nothing if the current scope is falsy
+        if len(scopes) != 1 and not scopes[-1]:
+            return ""
+        return template.replace("\n", "\n" + padding) if padding else template
+
+    if isinstance(template, str):
+        renderer, args = _get_renderer(template, ctx.def_ldel, ctx.def_rdel)
+        return renderer(*args, scopes, padding, ctx)
+
+    tokens, ends = _get_tokens(template, ctx.def_ldel, ctx.def_rdel)
+    return _render(tokens, ends, scopes, padding, ctx)
+
+
+def _render(tokens, ends, scopes, padding, ctx: _Context):
+    """Render tokens, for render() and the partials and lambdas within"""
+
+    no_escape = ctx.no_escape
+    nl_pad = "\n" + padding
+    get_key = _get_key
+    html_escape = _html_escape
+    output_parts = []
+    append = output_parts.append
+
+    # Sections over sequences are rendered by this same loop. Each frame
+    # holds the section's tags and what to return to once all of the
+    # items have been rendered:
+    # (section start, section end, outer n, scopes, output start, items)
+    frames = []
+
+    # Where the output of the current item (or of the template) starts
+    output_start = 0
 
     # Run through the tokens
-    for tag, key in tokens:
-        # Set the current scope
-        current_scope = scopes[0]
+    i = 0
+    n = len(tokens)
+    while True:
+        # If we're at the end of the tokens
+        if i >= n:
+            # And we aren't in a section then we're done
+            if not frames:
+                break
+
+            # Otherwise render the section tags for the next item
+            start, end, outer_n, outer_scopes, outer_start, items = frames[-1]
+            thing = next(items, _MISSING)
+            if thing is _MISSING:
+                # Unless there are none left, then carry on after the section
+                frames.pop()
+                i, n = end + 1, outer_n
+                scopes, output_start = outer_scopes, outer_start
+            else:
+                # Add it as the most recent scope and render
+                scopes = outer_scopes + [thing]
+                output_start = len(output_parts)
+                i = start
+            continue
+
+        tag, key = tokens[i]
+        i += 1
 
         # If we're an end tag
         if tag == "end":
             # Pop out of the latest scope
-            del scopes[0]
+            scopes.pop()
 
         # If the current scope is falsy and not the only scope
-        elif not current_scope and len(scopes) != 1:
+        elif len(scopes) != 1 and not scopes[-1]:
             if tag in ["section", "inverted section"]:
                 # Set the most recent scope to a falsy value
                 # (I heard False is a good one)
-                scopes.insert(0, False)
+                scopes.append(False)
 
         # If we're a literal tag
         elif tag == "literal":
             # Add padding to the key and add it to the output
-            output += key.replace("\n", "\n" + padding)
+            if padding and "\n" in key:
+                append(key.replace("\n", nl_pad))
+            else:
+                append(key)
 
         # If we're a variable tag
         elif tag == "variable":
             # Add the html escaped key to the output
-            thing = _get_key(
-                key,
-                scopes,
-                on_missing_key=on_missing_key,
-                keep=keep,
-                def_ldel=def_ldel,
-                def_rdel=def_rdel,
-            )
+            thing = get_key(key, scopes, ctx)
             if thing is True and key == ".":
                 # if we've coerced into a boolean by accident
                 # (inverted tags do this)
                 # then get the un-coerced object (next in the stack)
-                thing = scopes[1]
-            if not isinstance(thing, str):
+                thing = scopes[-2]
+            # (most things are exactly strings, which is quicker to check)
+            if thing.__class__ is not str and not isinstance(thing, str):
                 thing = str(thing)
-            output += thing if no_escape else _html_escape(thing)
+            # Empty strings, like missing keys, have nothing to add
+            if thing:
+                append(thing if no_escape else html_escape(thing))
 
         # If we're a no html escape tag
         elif tag == "no escape":
             # Just lookup the key and add it
-            thing = _get_key(
-                key,
-                scopes,
-                on_missing_key=on_missing_key,
-                keep=keep,
-                def_ldel=def_ldel,
-                def_rdel=def_rdel,
-            )
-            if not isinstance(thing, str):
+            thing = get_key(key, scopes, ctx)
+            if thing.__class__ is not str and not isinstance(thing, str):
                 thing = str(thing)
-            output += thing
+            if thing:
+                append(thing)
 
         # If we're a section tag
         elif tag == "section":
             # Get the sections scope
-            scope = _get_key(
-                key,
-                scopes,
-                on_missing_key=on_missing_key,
-                keep=keep,
-                def_ldel=def_ldel,
-                def_rdel=def_rdel,
-            )
+            scope = get_key(key, scopes, ctx)
 
             # If the scope is a callable (as described in
             # https://mustache.github.io/mustache.5.html)
-            if isinstance(scope, Callable):
-                # Generate template text from tags
-                text = ""
-                tags = []
-                for tag in tokens:
-                    if tag == ("end", key):
-                        break
-
-                    tags.append(tag)
-                    tag_type, tag_key = tag
-                    if tag_type == "literal":
-                        text += tag_key
-                    elif tag_type == "no escape":
-                        text += "%s& %s %s" % (def_ldel, tag_key, def_rdel)
-                    else:
-                        text += "%s%s %s%s" % (
-                            def_ldel,
-                            {
-                                "commment": "!",
-                                "section": "#",
-                                "inverted section": "^",
-                                "end": "/",
-                                "partial": ">",
-                                "set delimiter": "=",
-                                "no escape": "&",
-                                "variable": "",
-                            }[tag_type],
-                            tag_key,
-                            def_rdel,
-                        )
-
-                g_token_cache[text] = tags
-
-                rend = scope(
-                    text,
-                    lambda template, data=None: render(
-                        template,
-                        data={},
-                        partials_path=partials_path,
-                        partials_ext=partials_ext,
-                        partials_dict=partials_dict,
-                        padding=padding,
-                        def_ldel=def_ldel,
-                        def_rdel=def_rdel,
-                        scopes=data and [data] + scopes or scopes,
-                        on_missing_key=on_missing_key,
-                        keep=keep,
-                        no_escape=no_escape,
-                    ),
-                )
-
-                output += rend
+            if callable(scope):
+                end = ends[i - 1]
+                append(_render_lambda(scope, tokens, i, end, scopes, padding, ctx))
+                i = end + 1
 
             # If the scope is a sequence, an iterator or generator but not
-            # derived from a string
-            elif isinstance(scope, (Sequence, Iterator)) and not isinstance(scope, str):
+            # derived from a string (checking for the usual lists and
+            # tuples first, as the abstract types are slower to check)
+            elif isinstance(scope, (list, tuple)) or (
+                not isinstance(scope, str) and isinstance(scope, (Sequence, Iterator))
+            ):
                 # Then we need to do some looping
 
-                # Gather up all the tags inside the section
-                # (And don't be tricked by nested end tags with the same key)
-                # TODO: This feels like it still has edge cases, no?
-                tags = []
-                tags_with_same_key = 0
-                for tag in tokens:
-                    if tag == ("section", key):
-                        tags_with_same_key += 1
-                    if tag == ("end", key):
-                        tags_with_same_key -= 1
-                        if tags_with_same_key < 0:
-                            break
-                    tags.append(tag)
-
-                # For every item in the scope
-                for thing in scope:
-                    # Append it as the most recent scope and render
-                    new_scope = [thing] + scopes
-                    rend = render(
-                        template=tags,
-                        scopes=new_scope,
-                        padding=padding,
-                        partials_path=partials_path,
-                        partials_ext=partials_ext,
-                        partials_dict=partials_dict,
-                        def_ldel=def_ldel,
-                        def_rdel=def_rdel,
-                        on_missing_key=on_missing_key,
-                        keep=keep,
-                        no_escape=no_escape,
-                    )
-                    output += rend
+                # Render the tags inside the section for every item in the
+                # scope, starting from the end of them to pick up the first
+                end = ends[i - 1]
+                frames.append((i, end, n, scopes, output_start, iter(scope)))
+                i = n = end
 
             else:
                 # Otherwise we're just a scope section
-                scopes.insert(0, scope)
+                scopes.append(scope)
 
         # If we're an inverted section
         elif tag == "inverted section":
             # Add the flipped scope to the scopes
-            scope = _get_key(
-                key,
-                scopes,
-                on_missing_key=on_missing_key,
-                keep=keep,
-                def_ldel=def_ldel,
-                def_rdel=def_rdel,
-            )
-            scopes.insert(0, not scope)
+            scope = get_key(key, scopes, ctx)
+            scopes.append(not scope)
 
         # If we're a partial
         elif tag == "partial":
-            # Load the partial
-            partial = _get_partial(key, partials_dict, partials_path, partials_ext)
-
-            # Find what to pad the partial with
-            left = output.rpartition("\n")[2]
-            part_padding = padding
-            if left.isspace():
-                part_padding += left
-
-            # Render the partial
-            part_out = render(
-                template=partial,
-                partials_path=partials_path,
-                partials_ext=partials_ext,
-                partials_dict=partials_dict,
-                def_ldel=def_ldel,
-                def_rdel=def_rdel,
-                padding=part_padding,
-                scopes=scopes,
-                on_missing_key=on_missing_key,
-                keep=keep,
-                no_escape=no_escape,
+            # Render the partial here rather than in a function of its own,
+            # so that recursive partials only take a frame per level
+            render_partial, args, part_padding, indented = _start_partial(
+                key, scopes, output_parts, output_start, padding, ctx
             )
+            part_out = render_partial(*args, scopes, part_padding, ctx)
+            append(part_out.rstrip(" \t") if indented else part_out)
 
-            # If the partial was indented
-            if left.isspace():
-                # then remove the spaces from the end
-                part_out = part_out.rstrip(" \t")
+    return "".join(output_parts)
 
-            # Add the partials output to the ouput
-            output += part_out
 
-    return output
+def _render_lambda(func, tokens, start, end, scopes, padding, ctx: _Context):
+    """Render a section whose scope is a callable (a lambda)"""
+
+    # Gather up all the tags inside the section
+    tags = tokens[start:end]
+
+    # Generate template text from tags
+    affixes = _tag_affixes(ctx.def_ldel, ctx.def_rdel)
+    text_parts = []
+    for tag_type, tag_key in tags:
+        before, after = affixes[tag_type]
+        text_parts.append(before + tag_key + after)
+    text = "".join(text_parts)
+
+    # The text doesn't always tokenize back into the same tags (a set
+    # delimiter tag doesn't), so rendering the text itself always reuses
+    # them. The cache only saves tokenizing it for other lambdas
+    ends = _section_ends(tags)
+    g_token_cache.put((text, ctx.def_ldel, ctx.def_rdel), (tags, ends))
+
+    def render_text(template, data=None):
+        template_scopes = data and scopes + [data] or scopes
+        if isinstance(template, Template):
+            return template._render_with(template_scopes, padding, ctx)
+
+        if template == text:
+            template_tokens, template_ends = tags, ends
+        else:
+            template_tokens, template_ends = _get_tokens(
+                template, ctx.def_ldel, ctx.def_rdel
+            )
+        return _render(template_tokens, template_ends, template_scopes, padding, ctx)
+
+    return func(text, render_text)
+
+
+def _start_partial(name, scopes, output_parts, output_start, padding, ctx: _Context):
+    """Get how to render a partial, indented to match the output before it
+
+    Returns the function to render the partial with and the arguments to
+    give it before (scopes, padding, ctx), the padding to give it, and
+    whether it's indented (then the spaces at the end of its output
+    should be removed).
+    """
+
+    # Load the partial
+    template = _get_partial(
+        name, ctx.partials_dict, ctx.partials_path, ctx.partials_ext
+    )
+
+    # Find what to pad the partial with, which is the output on the
+    # current line. Rather than joining all of the output, look back
+    # through growing chunks of it until one has a newline
+    end = len(output_parts)
+    size = 16
+    line_start = end - size
+    while line_start > output_start and "\n" not in "".join(
+        output_parts[line_start:end]
+    ):
+        end = line_start
+        size *= 2
+        line_start = end - size
+    if line_start < output_start:
+        line_start = output_start
+    left = "".join(output_parts[line_start:]).rpartition("\n")[2]
+    indented = left.isspace()
+    part_padding = padding + left if indented else padding
+
+    # Template strings with tags are rendered by their compiled function
+    # or the interpreter directly, everything else goes through
+    # _render_template
+    if isinstance(template, str) and ctx.def_ldel in template:
+        render_partial, args = _get_renderer(template, ctx.def_ldel, ctx.def_rdel)
+    else:
+        render_partial, args = _render_template, (template,)
+
+    return render_partial, args, part_padding, indented
+
+
+#
+# Template compilation
+#
+
+
+def _compile(tokens, ends):
+    """Compile tokens into a Python function that renders them
+
+    The function takes the same (scopes, padding, ctx) as _render, but
+    the tags are dispatched on once, when generating its source, rather
+    than every time the template is rendered. Returns None if the tokens
+    are nested too deeply for Python to compile, and raises RecursionError
+    if there isn't enough of the stack left to compile them.
+    """
+
+    def lookup(key):
+        # The current scope is the only place a dot can be found
+        if key == ".":
+            return "v = scopes[-1]"
+        return "v = get_key(%r, scopes, ctx)" % key
+
+    def indent(lines):
+        return ["    " + line for line in lines]
+
+    def generate(start, stop, depth):
+        # Generate the lines for the tokens between start and stop. Each
+        # item of a section keeps where its output starts (for indenting
+        # partials), named by how deep the section is
+        o = "o%d" % depth
+        lines = []
+        i = start
+        while i < stop:
+            tag, key = tokens[i]
+            i += 1
+
+            if tag == "literal":
+                if "\n" in key:
+                    # Only pad the lines when there is padding
+                    lines.append(
+                        "append(%r.replace('\\n', nl_pad) if padding else %r)"
+                        % (key, key)
+                    )
+                elif key:
+                    lines.append("append(%r)" % key)
+
+            elif tag == "variable" or tag == "no escape":
+                lines.append(lookup(key))
+                if tag == "variable" and key == ".":
+                    # if we've coerced into a boolean by accident
+                    # (inverted tags do this)
+                    # then get the un-coerced object (next in the stack)
+                    lines.append("if v is True:")
+                    lines.append("    v = scopes[-2]")
+                lines.append("if v.__class__ is not str and not isinstance(v, str):")
+                lines.append("    v = str(v)")
+                if tag == "variable":
+                    lines.append("if v:")
+                    lines.append("    append(v if no_escape else html_escape(v))")
+                else:
+                    lines.append("if v:")
+                    lines.append("    append(v)")
+
+            elif tag == "section":
+                end = ends[i - 1]
+                lines.append(lookup(key))
+                lines.append("if callable(v):")
+                lines.append(
+                    "    append(render_lambda(v, tokens, %d, %d, scopes, padding, ctx))"
+                    % (i, end)
+                )
+                lines.append("else:")
+                lines.append(
+                    "    if isinstance(v, (list, tuple)) or (not isinstance(v, str) "
+                    "and isinstance(v, (Sequence, Iterator))):"
+                )
+                lines.append("        q%d = True" % depth)
+                lines.append("    else:")
+                # Otherwise we're just a scope section, rendered once
+                # with the scope and the start of the output we're in
+                lines.append("        q%d, v = False, (v,)" % depth)
+
+                item = "t%d" % depth
+                body = generate(i, end, depth + 1)
+                lines.append("    for %s in v:" % item)
+                if body:
+                    # Falsy items render nothing
+                    lines.append("        if %s:" % item)
+                    lines.append("            push(%s)" % item)
+                    lines.append(
+                        "            o%d = len(out) if q%d else %s"
+                        % (depth + 1, depth, o)
+                    )
+                    lines.extend(indent(indent(indent(body))))
+                    lines.append("            pop()")
+                else:
+                    lines.append("        pass")
+                i = end + 1
+
+            elif tag == "inverted section":
+                end = ends[i - 1]
+                body = generate(i, end, depth)
+                lines.append(lookup(key))
+                if body:
+                    lines.append("if not v:")
+                    lines.append("    push(True)")
+                    lines.extend(indent(body))
+                    lines.append("    pop()")
+                i = end + 1
+
+            elif tag == "partial":
+                # Rendered here, so recursive partials take a frame per level
+                lines.append(
+                    "r, a, p, w = start_partial(%r, scopes, out, %s, padding, ctx)"
+                    % (key, o)
+                )
+                lines.append("v = r(*a, scopes, p, ctx)")
+                lines.append("append(v.rstrip(' \\t') if w else v)")
+
+        return lines
+
+    body = generate(0, len(tokens), 0)
+    source = "\n".join(
+        [
+            "def compiled(scopes, padding, ctx):",
+            "    # If the current scope is falsy and not the only scope",
+            "    if len(scopes) != 1 and not scopes[-1]:",
+            "        return ''",
+            "    out = []",
+            "    append = out.append",
+            "    push, pop = scopes.append, scopes.pop",
+            "    nl_pad = '\\n' + padding",
+            "    no_escape = ctx.no_escape",
+            "    o0 = 0",
+        ]
+        + indent(body)
+        + ["    return ''.join(out)"]
+    )
+    namespace = {
+        # Warnings from the compiled function come from this module
+        "__name__": __name__,
+        "Iterator": Iterator,
+        "Sequence": Sequence,
+        "get_key": _get_key,
+        "html_escape": _html_escape,
+        "render_lambda": _render_lambda,
+        "start_partial": _start_partial,
+        "tokens": tokens,
+    }
+    try:
+        exec(builtins.compile(source, "<chevron-blue template>", "exec"), namespace)
+    except SyntaxError:
+        # Too many levels of indentation or nested blocks
+        return None
+
+    return namespace["compiled"]
+
+
+# Compiled functions of template strings, keyed by the template and
+# the delimiters. Compiling a template costs about as much as rendering
+# it 20 times, so templates are interpreted the first time they are
+# seen and only compiled if they are rendered again
+_COMPILE_CACHE_SIZE = 512
+_compiled_templates = _LRU(_COMPILE_CACHE_SIZE)
+_seen_templates = _LRU(_COMPILE_CACHE_SIZE)
+
+
+def _get_compiled(template, def_ldel, def_rdel):
+    """Get the compiled function of a template string
+
+    Returns None the first time a template is seen, and for templates
+    that can't be compiled (or can't be yet, this deep in the stack).
+    """
+    key = (template, def_ldel, def_rdel)
+    compiled = _compiled_templates.get(key, _MISSING)
+    if compiled is not _MISSING:
+        return compiled
+
+    if _seen_templates.get(key) is None:
+        _seen_templates.put(key, True)
+        return None
+
+    try:
+        compiled = _compile(*_tokenize_cached(template, def_ldel, def_rdel))
+    except RecursionError:
+        # Which doesn't say anything about the template, so leave it to be
+        # compiled the next time
+        return None
+    _compiled_templates.put(key, compiled)
+    return compiled
+
+
+def _get_renderer(template, def_ldel, def_rdel):
+    """Get a function that renders a template string with tags
+
+    This is its compiled function if it has one, or the interpreter
+    otherwise (including for lambda text, rendered only once). Returns
+    the function and the arguments to give it before (scopes, padding,
+    ctx), which are the tokens and section ends for the interpreter.
+    Callers pass those themselves rather than binding them with
+    functools.partial, whose call would count towards the recursion
+    limit on some Pythons, halving how deep partials can recurse.
+    """
+    cached = g_token_cache.get((template, def_ldel, def_rdel))
+    if cached is None:
+        compiled = _get_compiled(template, def_ldel, def_rdel)
+        if compiled is not None:
+            return compiled, ()
+        cached = _tokenize_cached(template, def_ldel, def_rdel)
+    return _render, cached
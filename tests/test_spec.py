@@ -1,63 +1,107 @@
 #!/usr/bin/python3
 
 import collections
+import functools
 import io
 import json
 import os
+import string
+import tempfile
+import types
 import unittest
+import warnings
+from pathlib import Path
+from unittest import mock
 
 import chevron_blue
 
+TESTS_DIR = Path(__file__).parent
+
 SPECS_PATH = os.path.join("spec", "specs")
-if os.path.exists(SPECS_PATH):
-    SPECS = [path for path in os.listdir(SPECS_PATH) if path.endswith(".json")]
+if os.path.isdir(SPECS_PATH):
+    # Ignore optional tests
+    with os.scandir(SPECS_PATH) as entries:
+        SPECS = [
+            entry.name
+            for entry in entries
+            if entry.name.endswith(".json") and not entry.name.startswith("~")
+        ]
 else:
     SPECS = []
 
+# Turns the name of a spec test into the name of its method
+_SLUG = str.maketrans(" -" + string.ascii_uppercase, "__" + string.ascii_lowercase)
+
+# Shared by the spec tests without any partials
+_EMPTY_PARTIALS = types.MappingProxyType({})
+
 STACHE = chevron_blue.render
+COMPILE = getattr(chevron_blue, "compile", None)
 
 
-def _test_case_from_path(json_path):
-    json_path = "%s.json" % json_path
+@functools.lru_cache(maxsize=None)
+def _load_spec(json_path):
+    """Load the test objects of a spec file"""
+    return tuple(json.loads(Path(json_path).read_bytes())["tests"])
+
 
-    class MustacheTestCase(unittest.TestCase):
-        """A simple yaml based test case"""
+def _run_case(self, template, data, partials, expected, desc):
+    """Render a spec test's template and check what it renders to"""
+    if isinstance(template, str):
+        # Template strings (and partials) are interpreted the first time
+        # they're seen and compiled after that, so forget the ones seen
+        # by other tests and render twice to check both
+        chevron_blue.renderer._seen_templates.clear()
+        chevron_blue.renderer._compiled_templates.clear()
+        result = STACHE(template, data, partials_dict=partials)
+        self.assertEqual(result, expected, desc)
 
-        def _test_from_object(obj):
-            """Generate a unit test from a test object"""
+    result = STACHE(template, data, partials_dict=partials)
+    self.assertEqual(result, expected, desc)
 
-            def test_case(self):
-                result = STACHE(
-                    obj["template"], obj["data"], partials_dict=obj.get("partials", {})
-                )
 
-                assert result == obj["expected"], obj["desc"]
+def _test_from_object(obj, spec, compiled=False):
+    """Generate a unit test from a test object"""
 
-            test_case.__doc__ = "suite: {0}    desc: {1}".format(spec, obj["desc"])
-            return test_case
+    template = obj["template"]
+    if compiled:
+        # Compile the template once, not every time the test runs
+        template = COMPILE(template)
 
-        with io.open(json_path, "r", encoding="utf-8") as f:
-            yaml = json.load(f)
+    return functools.partialmethod(
+        _run_case,
+        template=template,
+        data=obj["data"],
+        partials=obj.get("partials") or _EMPTY_PARTIALS,
+        expected=obj["expected"],
+        desc="suite: {0}    desc: {1}".format(spec, obj["desc"]),
+    )
 
-        # Generates a unit test for each test object
-        for i, test in enumerate(yaml["tests"]):
-            vars()[
-                "test_" + test["name"].lower().replace(" ", "_").replace("-", "_")
-            ] = _test_from_object(test)
 
-        def __repr__(self) -> str:
-            return f"<GeneratedMustacheTestCase json_path={json_path}>"
+def _test_case_from_path(json_path):
+    spec = os.path.basename(json_path)
+    json_path = "%s.json" % json_path
+
+    def __repr__(self) -> str:
+        return f"<GeneratedMustacheTestCase json_path={json_path}>"
+
+    methods = {"__doc__": "A simple yaml based test case", "__repr__": __repr__}
+
+    # Generates a unit test for each test object
+    for test in _load_spec(json_path):
+        name = "test_" + test["name"].translate(_SLUG)
+        methods[name] = _test_from_object(test, spec)
+        if COMPILE is not None:
+            methods[name + "_compiled"] = _test_from_object(test, spec, True)
 
     # Return the built class
-    return MustacheTestCase
+    return type("MustacheTestCase_" + spec, (unittest.TestCase,), methods)
 
 
 # Create TestCase for each json file
 for spec in SPECS:
-    # Ignore optional tests
-    if spec[0] != "~":
-        spec = spec.split(".")[0]
-        globals()[spec] = _test_case_from_path(os.path.join(SPECS_PATH, spec))
+    spec = spec.split(".")[0]
+    globals()[spec] = _test_case_from_path(os.path.join(SPECS_PATH, spec))
 
 
 class ExpandedCoverage(unittest.TestCase):
@@ -106,6 +150,30 @@ class ExpandedCoverage(unittest.TestCase):
 
         self.assertEqual(result, expected)
 
+    def test_indented_tagless_partial(self):
+        args = {
+            "template": "before\n  {{> plain }}\nafter",
+            "partials_dict": {"plain": "one\ntwo\n"},
+        }
+
+        result = chevron_blue.render(**args)
+        expected = "before\n  one\n  two\nafter"
+
+        self.assertEqual(result, expected)
+
+    def test_partial_indentation_after_long_output(self):
+        args = {
+            "template": "{{#list}}{{.}},{{/list}}\n {{#list}} {{/list}}{{> part }}",
+            "data": {"list": list(range(1, 51))},
+            "partials_dict": {"part": "a\nb"},
+        }
+
+        result = chevron_blue.render(**args)
+        line = " " * 51
+        expected = ",".join(map(str, range(1, 51))) + ",\n" + line + "a\n" + line + "b"
+
+        self.assertEqual(result, expected)
+
     def test_missing_key_partial(self):
         args = {
             "template": "before, {{> with_missing_key }}, after",
@@ -119,6 +187,21 @@ class ExpandedCoverage(unittest.TestCase):
 
         self.assertEqual(result, expected)
 
+    def test_partials_dict_missing(self):
+        class LazyPartials(dict):
+            def __missing__(self, name):
+                return "<" + name + ">"
+
+        args = {
+            "template": "a{{> one }}{{> two }}b",
+            "partials_dict": LazyPartials(),
+        }
+
+        result = chevron_blue.render(**args)
+        expected = "a<one><two>b"
+
+        self.assertEqual(result, expected)
+
     def test_listed_data(self):
         args = {"template": "{{# . }}({{ . }}){{/ . }}", "data": [1, 2, 3, 4, 5]}
 
@@ -129,11 +212,12 @@ class ExpandedCoverage(unittest.TestCase):
 
     def test_main(self):
         result = chevron_blue.main(
-            "tests/test.mustache", "tests/data.json", partials_path="tests"
+            str(TESTS_DIR / "test.mustache"),
+            str(TESTS_DIR / "data.json"),
+            partials_path=str(TESTS_DIR),
         )
 
-        with io.open("tests/test.rendered", "r", encoding="utf-8") as f:
-            expected = f.read()
+        expected = (TESTS_DIR / "test.rendered").read_text("utf-8")
 
         self.assertEqual(result, expected)
 
@@ -182,6 +266,39 @@ class ExpandedCoverage(unittest.TestCase):
 
         self.assertEqual(result, expected)
 
+    def test_list_index(self):
+        args = {
+            "template": "{{list.1}} {{list.-1.x}} {{tuple.0}} [{{list.5}}]",
+            "data": {"list": [1, 2, {"x": 3}], "tuple": ("a",)},
+        }
+
+        result = chevron_blue.render(**args)
+        expected = "2 3 a []"
+
+        self.assertEqual(result, expected)
+
+    def test_scopes(self):
+        scopes = [{"a": "inner"}, {"a": "outer", "b": "outer"}]
+        args = {
+            "template": "{{a}} {{b}} {{#b}}{{.}} {{a}}{{/b}}",
+            "scopes": scopes,
+        }
+
+        result = chevron_blue.render(**args)
+        expected = "inner outer outer inner"
+
+        self.assertEqual(result, expected)
+        self.assertEqual(scopes, [{"a": "inner"}, {"a": "outer", "b": "outer"}])
+
+    def test_tuple_scopes(self):
+        args = {"template": "{{a}}!", "scopes": ({"a": 1},)}
+
+        # The second render is compiled, which pushes onto the scopes
+        result = [chevron_blue.render(**args), chevron_blue.render(**args)]
+        expected = ["1!", "1!"]
+
+        self.assertEqual(result, expected)
+
     # https://github.com/noahmorrison/chevron/issues/17
     def test_inverted_coercion(self):
         args = {
@@ -205,12 +322,13 @@ class ExpandedCoverage(unittest.TestCase):
             "data": {"foo": "xx"},
         }
 
-        # self.assertRaisesRegex does not exist in python2.6
-        for _ in range(10):
-            try:
+        # The tokenizer counts lines in a module global, so render more
+        # than once to check that it's reset for every template
+        for _ in range(2):
+            with self.assertRaises(chevron_blue.ChevronError) as raised:
                 chevron_blue.render(**args)
-            except chevron_blue.ChevronError as error:
-                self.assertEqual(error.msg, "unclosed tag at line 3")
+
+            self.assertEqual(raised.exception.msg, "unclosed tag at line 3")
 
     def test_no_opening_tag(self):
         args = {
@@ -218,15 +336,13 @@ class ExpandedCoverage(unittest.TestCase):
             "data": {"foo": "xx"},
         }
 
-        try:
+        with self.assertRaises(chevron_blue.ChevronError) as raised:
             chevron_blue.render(**args)
-        except chevron_blue.ChevronError as error:
-            self.assertEqual(
-                error.msg,
-                'Trying to close tag "closing_tag"\n'
-                "Looks like it was not opened.\n"
-                "line 2",
-            )
+
+        self.assertEqual(
+            raised.exception.msg,
+            'Trying to close tag "closing_tag"\nLooks like it was not opened.\nline 2',
+        )
 
     # https://github.com/noahmorrison/chevron/issues/17
     def test_callable_1(self):
@@ -325,6 +441,134 @@ class ExpandedCoverage(unittest.TestCase):
 
         self.assertEqual(result, expected)
 
+    def test_callable_nested_same_key(self):
+        def wrap(content, render):
+            return "(" + render(content) + ")"
+
+        args = {
+            "template": "{{#wrap}}{{#wrap}}x{{/wrap}}{{/wrap}}!",
+            "data": {"wrap": wrap},
+        }
+
+        result = chevron_blue.render(**args)
+        expected = "((x))!"
+
+        self.assertEqual(result, expected)
+
+    def test_callable_cache_delimiters(self):
+        args = {
+            "template": "<%#wrap%>{{ x}}<%/wrap%>",
+            "data": {"wrap": lambda text, render: render(text), "x": 1},
+            "def_ldel": "<%",
+            "def_rdel": "%>",
+        }
+
+        result = chevron_blue.render(**args)
+        self.assertEqual(result, "{{ x}}")
+
+        args = {
+            "template": "{{#wrap}}{{/wrap}}",
+            "data": {"wrap": lambda text, render: render("{{ x}}"), "x": 1},
+        }
+
+        result = chevron_blue.render(**args)
+        self.assertEqual(result, "1")
+
+    def test_set_cache_size(self):
+        args = {
+            "template": "{{#wrap}}{{x}}{{/wrap}}",
+            "data": {"wrap": lambda text, render: render(text) * 2, "x": 1},
+        }
+
+        # Sections whose text doesn't tokenize back into their tags
+        delimiter_args = {
+            "template": "{{#wrap}}{{=| |=}}|x||/wrap|",
+            "data": {"wrap": lambda text, render: render(text), "x": 1},
+        }
+
+        chevron_blue.set_cache_size(0)
+        try:
+            result = [
+                chevron_blue.render(**args),
+                chevron_blue.render(**delimiter_args),
+            ]
+        finally:
+            chevron_blue.set_cache_size(chevron_blue.renderer._TOKEN_CACHE_SIZE)
+        expected = ["11", "1"]
+
+        self.assertEqual(result, expected)
+
+    def test_bad_cache_size(self):
+        self.assertRaises(ValueError, chevron_blue.set_cache_size, -1)
+        self.assertRaises(TypeError, chevron_blue.set_cache_size, "10")
+
+    def test_compile(self):
+        template = chevron_blue.compile(
+            io.StringIO("<% greeting %>, <%> who %>!"), def_ldel="<%", def_rdel="%>"
+        )
+        partials = {"who": "<% name %>"}
+
+        result = [
+            template.render(
+                {"greeting": "Hello", "name": "World"}, partials_dict=partials
+            ),
+            template.render(
+                {"greeting": "<Bye>", "name": "you"},
+                partials_dict=partials,
+                no_escape=True,
+            ),
+        ]
+        expected = ["Hello, World!", "<Bye>, you!"]
+
+        self.assertEqual(result, expected)
+
+    def test_compile_rendered_by_lambda(self):
+        template = chevron_blue.compile("<b>{{name}}</b>")
+        args = {
+            "template": "{{#bold}}ignored{{/bold}}",
+            "data": {
+                "bold": lambda text, render: render(template, {"name": "World"}),
+            },
+        }
+
+        result = chevron_blue.render(**args)
+        expected = "<b>World</b>"
+
+        self.assertEqual(result, expected)
+
+    def test_deeply_nested_sections(self):
+        args = {
+            "template": "{{#list}}" * 30 + "{{.}}" + "{{/list}}" * 30,
+            "data": {"list": [1]},
+        }
+
+        result = chevron_blue.render(**args)
+        expected = "1"
+
+        self.assertEqual(result, expected)
+
+    def test_deeply_recursive_partials(self):
+        data = {"v": 0}
+        node = data
+        for i in range(1, 800):
+            node["c"] = node = {"v": i}
+        node["c"] = False
+
+        args = {
+            "template": "{{>node}}",
+            "data": data,
+            "partials_dict": {"node": "{{v}},{{#c}}{{>node}}{{/c}}"},
+        }
+
+        # Render with the interpreter only, then compiled
+        with mock.patch.object(chevron_blue.renderer, "_get_compiled") as compiled:
+            compiled.return_value = None
+            result = [chevron_blue.render(**args)]
+        result += [chevron_blue.render(**args) for _ in range(2)]
+        expected = "".join("%d," % i for i in range(800))
+
+        self.assertEqual(result, [expected] * 3)
+
     # https://github.com/noahmorrison/chevron/issues/35
     def test_custom_falsy(self):
         class CustomData(dict):
@@ -422,6 +666,18 @@ class ExpandedCoverage(unittest.TestCase):
 
         self.assertEqual(result, expected)
 
+    def test_section_item_partial_indentation(self):
+        args = {
+            "data": {"list": [1, 2]},
+            "template": "x{{#list}} {{> part }}{{/list}}",
+            "partials_dict": {"part": "{{.}}\n{{.}}"},
+        }
+
+        result = chevron_blue.render(**args)
+        expected = "x 1\n 1 2\n 2"
+
+        self.assertEqual(result, expected)
+
     # https://github.com/noahmorrison/chevron/pull/73
     def test_namedtuple_data(self):
         NT = collections.namedtuple("NT", ["foo", "bar"])
@@ -446,17 +702,34 @@ class ExpandedCoverage(unittest.TestCase):
         self.assertEqual(result, expected)
 
     def test_disabled_partials(self):
-        os.chdir("tests")
-        resultNone = chevron_blue.main("test.mustache", "data.json", partials_path=None)
+        template = str(TESTS_DIR / "test.mustache")
+        data = str(TESTS_DIR / "data.json")
 
-        resultEmpty = chevron_blue.main("test.mustache", "data.json", partials_path="")
+        resultNone = chevron_blue.main(template, data, partials_path=None)
 
-        with io.open("test-partials-disabled.rendered", "r", encoding="utf-8") as f:
-            expected = f.read()
+        resultEmpty = chevron_blue.main(template, data, partials_path="")
+
+        expected = (TESTS_DIR / "test-partials-disabled.rendered").read_text("utf-8")
 
         self.assertEqual(resultNone, expected)
         self.assertEqual(resultEmpty, expected)
-        os.chdir("..")
+
+    def test_modified_partial_file(self):
+        with tempfile.TemporaryDirectory() as partials_path:
+            partial_path = os.path.join(partials_path, "part.mustache")
+            args = {"template": "{{> part }}", "partials_path": partials_path}
+
+            with io.open(partial_path, "w", encoding="utf-8") as f:
+                f.write("first")
+            os.utime(partial_path, ns=(0, 0))
+
+            self.assertEqual(chevron_blue.render(**args), "first")
+
+            with io.open(partial_path, "w", encoding="utf-8") as f:
+                f.write("second")
+            os.utime(partial_path, ns=(1, 1))
+
+            self.assertEqual(chevron_blue.render(**args), "second")
 
     # https://github.com/noahmorrison/chevron/pull/94
     def test_keep(self):
@@ -562,6 +835,19 @@ class Teston_missing_key(unittest.TestCase):
         with self.assertWarns(UserWarning, msg="Could not find key 'missing'"):
             chevron_blue.render(**args)
 
+    def test_on_missing_key_warn_module_filter(self):
+        args = {
+            "template": "{{missing}} by module",
+            "data": {},
+            "on_missing_key": "warn",
+        }
+
+        # The second render is compiled, and should warn from the same module
+        with warnings.catch_warnings():
+            warnings.filterwarnings("error", module="chevron_blue")
+            for _ in range(2):
+                self.assertRaises(UserWarning, chevron_blue.render, **args)
+
     def test_on_missing_key_error(self):
         args = {
             "template": "{{missing}}",